@@ -134,6 +134,15 @@ class BaseModelStore(BaseModelClient):
         with open(path, 'rb') as mf:
             return self.put_model(pickle.load(mf))
 
+    def put_serialized_raw(self, path):
+        """
+        Load a serialized model into the store, copying its bytes directly if the
+        store's storage format allows it.
+
+        The base class method calls :meth:`put_serialized`.
+        """
+        return self.put_serialized(path)
+
     @abstractmethod
     def client(self):
         """
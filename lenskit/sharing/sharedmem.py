@@ -4,77 +4,366 @@ Sharing support using Python 3.8 shared memory.
 A key consists of the following:
 
 * An identifier
-* Serialized bytes of the pickled data
-* A list of buffer specifiers
+* A buffer specifier for the pickled data
+* A list of buffer specifiers for the out-of-band buffers
 
 Because shared memory buffers can be larger than requested to accomodate page
 alignment, we need to track not only the shared memory name but also the buffer
-size.  Buffer specifiers are ``(name, size)`` pairs.
+size.  Small buffers are also packed together into shared *arena* blocks, so we
+need their offset within the block too.  Buffer specifiers are therefore
+``(name, offset, size)`` triples.
+
+The pickled data lives in shared memory too, so the key itself is small and
+cheap to send to worker processes.
 """
 
+from collections import OrderedDict
 from typing import NamedTuple
+import os
+import io
 import logging
+import mmap
 import pickle
+import struct
+import threading
 import uuid
+import weakref
+
+import numpy as np
 
 try:
     import multiprocessing.shared_memory as shm
 except ImportError:
     shm = None
 
+# CPython's private helper behind shared_memory on POSIX; if it is missing or
+# changes shape, the client falls back to SharedMemory
+try:
+    import _posixshmem
+except ImportError:
+    _posixshmem = None
+if not hasattr(_posixshmem, 'shm_open'):
+    _posixshmem = None
+
 from . import BaseModelClient, BaseModelStore, sharing_mode
 
 _log = logging.getLogger(__name__)
 
+#: Alignment (in bytes) of buffers packed into an arena.
+_ALIGN = 64
+#: Buffers smaller than this are packed into an arena instead of getting their own block.
+_ARENA_THRESHOLD = 64 * 1024
+#: Size of the first arena block; later blocks double in size.
+_ARENA_INIT_SIZE = 1024 * 1024
+#: Largest size an arena block grows to.
+_ARENA_MAX_SIZE = 64 * 1024 * 1024
+#: Default size (in bytes) of the client model cache.
+_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+#: Blocks at least this large are marked for transparent huge pages.
+_HUGEPAGE_THRESHOLD = 2 * 1024 * 1024
+
+
+# packed key layout: model ID and buffer count, then (name length, name, offset, size)
+# for the pickle data and each buffer
+_KEY_HEAD = struct.Struct('<16sI')
+_SPEC_NAME = struct.Struct('<H')
+_SPEC_POS = struct.Struct('<QQ')
+
+
+def _align(n):
+    "Round ``n`` up to a multiple of :data:`_ALIGN`."
+    return (n + _ALIGN - 1) & ~(_ALIGN - 1)
+
+
+def _address(buf):
+    "Get the memory address of the start of a buffer."
+    return np.frombuffer(buf, np.uint8, 1).ctypes.data
+
+
+def _advise(block, nbytes):
+    """
+    Tell the kernel we are about to fill a new block, so it can fault the pages in
+    ahead of the copy (and back large blocks with huge pages where supported).
+
+    :class:`shm.SharedMemory` does not expose its mapping, so this uses its private
+    ``_mmap`` attribute; if that is missing, or the platform has no ``madvise``
+    (Windows), we skip the advice.
+    """
+    mm = getattr(block, '_mmap', None)
+    if not hasattr(mm, 'madvise'):
+        return
+
+    _madvise(block, mm, mmap.MADV_WILLNEED)
+    if nbytes >= _HUGEPAGE_THRESHOLD:
+        _madvise(block, mm, getattr(mmap, 'MADV_HUGEPAGE', None))
+
+
+def _madvise(block, mm, advice):
+    if advice is None:
+        return  # not supported on this platform
+    try:
+        mm.madvise(advice)
+    except OSError as e:
+        _log.debug('madvise(%d) failed on %s: %s', advice, block.name, e)
+
+
+def _alloc_block(nbytes):
+    """
+    Create a shared memory block for a single buffer, returning the block and the
+    offset of the first :data:`_ALIGN`-aligned byte.  Mappings are page-aligned on
+    every platform we know of, so this is normally 0; we only pad the block if the
+    platform gives us an unaligned mapping.
+    """
+    block = shm.SharedMemory(create=True, size=nbytes)
+    off = -_address(block.buf) & (_ALIGN - 1)
+    if off:
+        _log.debug('%s is misaligned, padding', block.name)
+        block.close()
+        block.unlink()
+        block = shm.SharedMemory(create=True, size=nbytes + _ALIGN - 1)
+        off = -_address(block.buf) & (_ALIGN - 1)
+    _advise(block, nbytes)
+    return block, off
+
+
+def _open_block(name):
+    """
+    Map an existing shared memory block for reading a model.  On POSIX we open and map
+    it directly, which takes fewer calls than :class:`shm.SharedMemory` and does not
+    register the block with the resource tracker (which unlinks tracked blocks when a
+    worker process exits).
+
+    Returns:
+        an object with the buffer protocol and a ``close()`` method.
+    """
+    if _posixshmem is None:
+        return shm.SharedMemory(name=name)
+
+    fd = _posixshmem.shm_open('/' + name, os.O_RDWR, mode=0o600)
+    try:
+        return mmap.mmap(fd, os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+
+
+def _block_view(block):
+    "Get a memory view of a block from :func:`_open_block`."
+    if isinstance(block, mmap.mmap):
+        return memoryview(block)
+    else:
+        return block.buf
+
+
+def _blit(dst, src):
+    """
+    Copy the bytes of ``src`` to the start of ``dst``.  NumPy does this with a
+    single ``memcpy``, instead of the generic buffer assignment path.
+    """
+    n = src.nbytes
+    np.copyto(np.frombuffer(dst, np.uint8, n), np.frombuffer(src, np.uint8, n))
+
 
 class SHMKey(NamedTuple):
     "Serialized key form for a shared memory model."
     id: uuid.UUID
     "Model identifier."
 
-    data: bytes
-    "The pickled data."
+    data: tuple
+    "The pickled data, as a (name, offset, size) triple."
 
     buffers: list
-    "A list of buffers, as (name, size) pairs."
+    "A list of buffers, as (name, offset, size) triples."
 
     def __str__(self):
-        nbs = len(self.data)
+        nbs = self.data[2]
         return f'SHMKey({self.id}: {nbs} bytes)'
 
+    def pack(self):
+        """
+        Pack the key into a compact byte string.
+
+        Returns:
+            bytes: the packed key, for :meth:`unpack`.
+        """
+        parts = [_KEY_HEAD.pack(self.id.bytes, len(self.buffers))]
+        for name, off, size in [self.data] + list(self.buffers):
+            name = name.encode('ascii')
+            parts.append(_SPEC_NAME.pack(len(name)))
+            parts.append(name)
+            parts.append(_SPEC_POS.pack(off, size))
+        return b''.join(parts)
+
+    @classmethod
+    def unpack(cls, packed):
+        """
+        Unpack a key packed with :meth:`pack`.
+        """
+        kid, nbufs = _KEY_HEAD.unpack_from(packed)
+        pos = _KEY_HEAD.size
+        specs = []
+        for i in range(nbufs + 1):
+            nlen, = _SPEC_NAME.unpack_from(packed, pos)
+            pos += _SPEC_NAME.size
+            name = packed[pos:pos+nlen].decode('ascii')
+            pos += nlen
+            off, size = _SPEC_POS.unpack_from(packed, pos)
+            pos += _SPEC_POS.size
+            specs.append((name, off, size))
+        return cls(uuid.UUID(bytes=kid), specs[0], specs[1:])
+
+    def __reduce__(self):
+        # send keys to workers as one byte string instead of a tree of small objects
+        return (SHMKey.unpack, (self.pack(),))
+
 
 class SHMClient(BaseModelClient):
-    _last_key = None
-    _last_model = None
-    _last_bufs = None
+    """
+    Client for models in shared memory.  The client keeps recently-used models
+    loaded, evicting the least-recently-used ones once their total size exceeds
+    the cache size.
+
+    Args:
+        cache_size(int):
+            The maximum total size, in bytes, of cached models.  Defaults to the
+            ``LK_SHM_CACHE_SIZE`` environment variable, or 2 GiB if it is not set.
+    """
+
+    cache_size = None
+    _cache = None
+    _cache_bytes = 0
+    _retired = ()
+
+    def __init__(self, cache_size=None):
+        self.cache_size = cache_size
+
+    def _cache_limit(self):
+        if self.cache_size is not None:
+            return self.cache_size
+        return int(os.environ.get('LK_SHM_CACHE_SIZE', _CACHE_SIZE))
 
     def get_model(self, key: SHMKey):
-        if self._last_key and self._last_key.id == key.id:
+        if self._cache is None:
+            self._cache = OrderedDict()
+
+        cached = self._cache.get(key.id)
+        if cached is not None:
             _log.debug('reusing model %s', key)
-        else:
-            self._last_model = None
-            self._last_bufs = None
-
-            _log.debug('loading model from %s', key)
-            buffers = []
-            shm_bufs = []
-            for bn, bs in key.buffers:
-                # funny business with buffer sizes
-                block = shm.SharedMemory(name=bn)
-                _log.debug('%s: %d bytes (%d used)', block.name, bs, block.size)
-                buffers.append(block.buf[:bs])
-                shm_bufs.append(block)
-            self._last_model = pickle.loads(key.data, buffers=buffers)
-            self._last_bufs = shm_bufs
-            self._last_key = key
-
-        return self._last_model
+            self._cache.move_to_end(key.id)
+            return cached[1]
+
+        size = key.data[2] + sum(bs for (bn, off, bs) in key.buffers)
+        limit = self._cache_limit()
+        while self._cache and self._cache_bytes + size > limit:
+            self._evict()
+
+        _log.debug('loading model from %s', key)
+        shm_bufs, model = self._load(key)
+
+        # tuples release their items last-to-first, so the model goes before its blocks
+        self._cache[key.id] = (shm_bufs, model, size)
+        self._cache_bytes += size
+        return model
+
+    def clear(self):
+        """
+        Drop all cached models and unmap their shared memory.  Blocks still in use by
+        models the caller holds stay mapped until the next eviction or ``clear()``.
+        """
+        while self._cache:
+            self._evict()
+        self._close_blocks([])
+
+    def _load(self, key):
+        "Map a model's blocks and unpickle it, returning the blocks and the model."
+        shm_bufs = {}
+        views = {}
+        for bn, off, bs in [key.data] + list(key.buffers):
+            # arena blocks hold many buffers, only map them once
+            if bn not in views:
+                shm_bufs[bn] = _open_block(bn)
+                views[bn] = _block_view(shm_bufs[bn])
+            _log.debug('%s: %d bytes at %d (%d total)', bn, bs, off, len(views[bn]))
+
+        def view(bn, off, bs):
+            return views[bn][off:off+bs]
+
+        # wrap so consumers can rebuild their storage directly over the block
+        buffers = [pickle.PickleBuffer(view(*spec)) for spec in key.buffers]
+        model = pickle.loads(view(*key.data), buffers=buffers)
+        return list(shm_bufs.values()), model
+
+    def _evict(self):
+        mid, (shm_bufs, model, size) = self._cache.popitem(last=False)
+        _log.debug('evicting model %s (%d bytes)', mid, size)
+        self._cache_bytes -= size
+        del model
+        self._close_blocks(shm_bufs)
+
+    def _close_blocks(self, blocks):
+        # blocks the caller is still using stay mapped until a later eviction
+        retired = []
+        for block in list(self._retired) + blocks:
+            try:
+                block.close()
+            except BufferError:
+                _log.debug('block still in use, leaving it mapped')
+                retired.append(block)
+        self._retired = retired
 
     def __getstate__(self):
         if isinstance(self, BaseModelStore):
             raise RuntimeError('stores cannot be pickled')
         else:
-            return {}  # nothing to pickle here
+            return {'cache_size': self.cache_size}  # the cache stays in this process
+
+
+class SHMArena:
+    """
+    Bump allocator that packs small buffers into shared memory blocks, saving a
+    block (and its page rounding) per buffer.  When the current block is full,
+    a new one twice as large is created.
+    """
+
+    def __init__(self, init_size=_ARENA_INIT_SIZE, max_size=_ARENA_MAX_SIZE):
+        self.blocks = []
+        self._next_size = init_size
+        self._max_size = max_size
+        self._block = None
+        self._capacity = 0
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    def alloc(self, nbytes):
+        """
+        Allocate space in the arena.
+
+        Args:
+            nbytes(int): the number of bytes required.
+
+        Returns:
+            tuple: the shared memory block and the offset of the allocation within it.
+        """
+        size = _align(nbytes)
+        with self._lock:
+            if self._block is None or self._offset + size > self._capacity:
+                self._capacity = max(self._next_size, size)
+                self._next_size = min(self._next_size * 2, self._max_size)
+                self._block = shm.SharedMemory(create=True, size=self._capacity)
+                _log.debug('created %d-byte arena block %s', self._capacity, self._block.name)
+                self.blocks.append(self._block)
+                self._offset = 0
+
+            offset = self._offset
+            self._offset += size
+            return self._block, offset
+
+    def close(self):
+        "Close and unlink the arena's blocks."
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+        self._block = None
 
 
 class SHMModelStore(BaseModelStore, SHMClient):
@@ -86,55 +375,143 @@ class SHMModelStore(BaseModelStore, SHMClient):
     depends on a Numpy version new enough to support Protocol 5 pickles.
 
     Args:
-        path:
-            the path to use; otherwise uses a new temp directory under
-            :func:`util.scratch_dir`.
-        reserialize:
-            if ``True`` (the default), models passed to :meth:`put_serialized` are
-            re-serialized in the SHM storage.
+        reuse_keys:
+            if ``True``, storing the same model object more than once returns the key
+            from the first :meth:`put_model` call instead of re-serializing it.  This
+            is only safe if models are not modified after they are stored.
     """
 
     ENABLED = shm is not None
 
+    reuse_keys: bool
+
+    def __init__(self, *, reuse_keys=False):
+        self.reuse_keys = reuse_keys
+
     def init(self):
         if not self.ENABLED:
             raise RuntimeError('Shared-memory model store requires Python 3.8 or later')
         self.buffers = {}
+        self.arena = SHMArena()
+        self._pickle_cache = {}
+        self._local_cache = weakref.WeakValueDictionary()
 
     def shutdown(self, *args):
+        # models the store loaded as its own client must not outlive their blocks
+        self.clear()
         for k, bs in self.buffers.items():
             for buf in bs:
                 buf.close()
                 buf.unlink()
         del self.buffers
+        self.arena.close()
+        del self.arena
+        del self._pickle_cache
+        del self._local_cache
 
     def client(self):
         return SHMClient()
 
+    def get_model(self, key: SHMKey):
+        # the storing process already has the model, no need to unpickle it
+        model = self._local_cache.get(key.id)
+        if model is not None:
+            _log.debug('using local model for %s', key)
+            return model
+        return super().get_model(key)
+
     def put_model(self, model):
-        buffers = []
+        key = self._cached_key(model)
+        if key is not None:
+            return key
+
+        blocks = []
         buf_keys = []
 
         def buf_cb(buf):
-            ba = buf.raw()
-            block = shm.SharedMemory(create=True, size=ba.nbytes)
-            _log.debug('serializing %d bytes to %s', ba.nbytes, block.name)
-            # blit the buffer into shared memory
-            block.buf[:ba.nbytes] = ba
-            buffers.append(block)
-            buf_keys.append((block.name, ba.nbytes))
+            buf_keys.append(self._put_buffer(buf.raw(), blocks))
 
-        id = uuid.uuid4()
+        mid = uuid.uuid4()
 
         with sharing_mode():
-            data = pickle.dumps(model, protocol=5, buffer_callback=buf_cb)
-            shm_bytes = sum(b.size for b in buffers)
+            out = io.BytesIO()
+            pickle.Pickler(out, protocol=5, buffer_callback=buf_cb).dump(model)
+            with out.getbuffer() as pv:
+                data = self._put_buffer(pv, blocks)
+            del out
+            shm_bytes = sum(bs for (bn, off, bs) in buf_keys)
             _log.info('serialized %s to %s (%d pickle bytes and %d buffers of %d bytes)',
-                      model, id, len(data), len(buffers), shm_bytes)
-
-        self.buffers[id] = buffers
-
-        return SHMKey(id, data, buf_keys)
+                      model, mid, data[2], len(buf_keys), shm_bytes)
+
+        self.buffers[mid] = blocks
+        key = SHMKey(mid, data, buf_keys)
+        self._remember(model, key)
+        return key
+
+    def put_serialized_raw(self, path):
+        """
+        Copy a pickled model file into shared memory without unpickling it.  Arrays in
+        a plain pickle are stored in-band, so each client unpickles its own copy of
+        them; use :meth:`put_serialized` to share array storage between processes.
+        """
+        blocks = []
+        with open(path, 'rb') as mf:
+            size = os.fstat(mf.fileno()).st_size
+            block, off = self._alloc(size, blocks)
+            _log.debug('copying %s (%d bytes) to %s at %d', path, size, block.name, off)
+            with block.buf[off:off+size] as dst:
+                pos = 0
+                while pos < size:
+                    n = mf.readinto(dst[pos:])
+                    if not n:
+                        raise EOFError(f'{path} truncated while reading')
+                    pos += n
+
+        mid = uuid.uuid4()
+        self.buffers[mid] = blocks
+        return SHMKey(mid, (block.name, off, size), [])
+
+    def _alloc(self, nbytes, blocks):
+        "Allocate shared memory for a buffer, adding any dedicated block to ``blocks``."
+        if nbytes < _ARENA_THRESHOLD:
+            return self.arena.alloc(nbytes)
+        else:
+            block, off = _alloc_block(nbytes)
+            blocks.append(block)
+            return block, off
+
+    def _put_buffer(self, ba, blocks):
+        """
+        Copy a buffer into shared memory, adding any dedicated block to ``blocks``.
+
+        Returns:
+            tuple: the buffer specifier.
+        """
+        block, off = self._alloc(ba.nbytes, blocks)
+        _log.debug('serializing %d bytes to %s at %d', ba.nbytes, block.name, off)
+        # blit the buffer into shared memory
+        _blit(block.buf[off:], ba)
+        return (block.name, off, ba.nbytes)
+
+    def _cached_key(self, model):
+        "Get the existing key for a model, if ``reuse_keys`` is on and it was stored."
+        if not self.reuse_keys:
+            return None
+        # the cache holds the model too, so its id cannot be recycled
+        cached = self._pickle_cache.get(id(model))
+        if cached is not None and cached[0] is model:
+            _log.debug('reusing key %s for %s', cached[1], model)
+            return cached[1]
+        return None
+
+    def _remember(self, model, key):
+        "Record a newly-stored model for local lookup and key reuse."
+        try:
+            self._local_cache[key.id] = model
+        except TypeError:
+            pass  # model does not support weak references
+        if self.reuse_keys:
+            self._pickle_cache[id(model)] = (model, key)
 
     def __str__(self):
         return 'SHMModelStore()'
@@ -3,6 +3,12 @@ Utilities to manage randomness in LensKit and LensKit experiments.
 """
 
 import zlib
+import secrets
+import threading
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None  # Python 3.6
 import numpy as np
 import random
 import warnings
@@ -10,6 +16,11 @@ import logging
 
 _log = logging.getLogger(__name__)
 
+#: The seed for the current context, if it has been set with :func:`init_rng`.
+#: ``None`` if :mod:`contextvars` is unavailable, in which case only the
+#: process-wide seed is used.
+_seed_var = ContextVar('lenskit_seed', default=None) if ContextVar else None
+
 
 class LegacyRNG:
     _seed = None
@@ -18,7 +29,8 @@ class LegacyRNG:
     @property
     def seed(self):
         if self._seed is None:
-            self._seed = np.random.randint(0, np.iinfo('i4').max)
+            # draw from OS entropy instead of seeding NumPy's global RNG
+            self._seed = secrets.randbits(31)
         return self._seed
 
     @property
@@ -34,7 +46,13 @@ class LegacyRNG:
             del self._rng
         return seed
 
-    def derive(self, keys):
+    def derive(self, base, keys):
+        raise NotImplementedError('legacy RNG does not support deriving seeds')
+
+    def derive_many(self, base, n):
+        raise NotImplementedError('legacy RNG does not support deriving seeds')
+
+    def derive_each(self, base, keys):
         raise NotImplementedError('legacy RNG does not support deriving seeds')
 
     def rng(self, seed=None):
@@ -48,17 +66,27 @@ class LegacyRNG:
 
 
 class ModernRNG:
+    # process-wide seed, used by contexts that have not been seeded themselves
     _seed = None
+    # (seed, integer seed) pair from the last int_seed call
+    _int_seed = None
 
     @property
     def seed(self):
-        if self._seed is None:
-            self._seed = np.random.SeedSequence()
-        return self._seed
+        seed = _seed_var.get() if _seed_var is not None else None
+        if seed is None:
+            if self._seed is None:
+                # SeedSequence draws fresh OS entropy when it is not given any
+                self._seed = np.random.SeedSequence()
+            seed = self._seed
+        return seed
 
     @property
     def int_seed(self):
-        return self._seed.generate_state(1)[0]
+        seed = self.seed
+        if self._int_seed is None or self._int_seed[0] is not seed:
+            self._int_seed = (seed, int(seed.generate_state(1)[0]))
+        return self._int_seed[1]
 
     def initialize(self, seed, keys):
         if isinstance(seed, int):
@@ -70,9 +98,16 @@ class ModernRNG:
         if keys:
             seed = self.derive(seed, keys)
 
-        self._seed = seed
+        self._set_seed(seed)
         return seed
 
+    def _set_seed(self, seed):
+        self._int_seed = None
+        if _seed_var is not None:
+            _seed_var.set(seed)
+        if _seed_var is None or threading.current_thread() is threading.main_thread():
+            self._seed = seed
+
     def derive(self, base, keys):
         if base is None:
             base = self.seed
@@ -83,6 +118,19 @@ class ModernRNG:
         else:
             return base.spawn(1)[0]
 
+    def derive_many(self, base, n):
+        if base is None:
+            base = self.seed
+
+        return base.spawn(n)
+
+    def derive_each(self, base, keys):
+        if base is None:
+            base = self.seed
+
+        return [np.random.SeedSequence(base.entropy, spawn_key=base.spawn_key + (k,))
+                for k in _make_ints(keys)]
+
     def rng(self, seed=None):
         if seed is None:
             seed, = self.seed.spawn(1)
@@ -98,18 +146,29 @@ def get_root_seed():
     Returns:
         numpy.random.SeedSequence: The LensKit root seed.
     """
-    return _rng_impl.seed()
+    return _rng_impl.seed
 
 
 def _make_int(obj):
-    if isinstance(obj, int):
-        return obj
+    if isinstance(obj, (int, np.integer)):
+        return int(obj)
     elif isinstance(obj, bytes):
         return zlib.crc32(obj)
     elif isinstance(obj, str):
         return zlib.crc32(obj.encode('utf8'))
     else:
-        return ValueError('invalid RNG key ' + str(obj))
+        raise ValueError('invalid RNG key ' + str(obj))
+
+
+def _make_ints(keys):
+    """
+    Convert many RNG keys to integers at once, with the same results as :func:`_make_int`.
+    Integer arrays (e.g. user IDs) are converted in one step instead of key-by-key.
+    """
+    if isinstance(keys, np.ndarray) and np.issubdtype(keys.dtype, np.integer):
+        return keys.tolist()
+    else:
+        return [_make_int(k) for k in keys]
 
 
 def init_rng(seed, *keys, propagate=True):
@@ -134,6 +193,12 @@ def init_rng(seed, *keys, propagate=True):
             with LensKit uses any of the global RNGs, they all use RNGs seeded with the
             specified seed.
 
+    On Python 3.7 and later, the seed is stored in a :mod:`contextvars` context variable
+    (on 3.6, it is a single process-wide seed).  When called from the
+    main thread, it also becomes the default seed for threads and contexts that have
+    not initialized their own; when called from another thread (or a task running in
+    a copied context), it only affects that context.
+
     Returns:
         The random seed.
     """
@@ -163,6 +228,23 @@ def derive_seed(*keys, base=None):
     return _rng_impl.derive(base, keys)
 
 
+def derive_seeds(n, *, base=None):
+    """
+    Derive several new seeds at once.  This is equivalent to calling :func:`derive_seed`
+    with no keys ``n`` times, but spawns all the seeds in a single operation.
+
+    Args:
+        n(int):
+            The number of seeds to derive.
+        base(numpy.random.SeedSequence):
+            The base seed to use.  If ``None``, uses the root seed.
+
+    Returns:
+        list of numpy.random.SeedSequence: the derived seeds.
+    """
+    return _rng_impl.derive_many(base, n)
+
+
 def rng(seed=None, *, legacy=False):
     """
     Get a random number generator.  This is similar to :func:`sklearn.utils.check_random_seed`, but
@@ -185,11 +267,11 @@ def rng(seed=None, *, legacy=False):
         numpy.random.Generator: A random number generator.
     """
 
-    rng = None
-    if isinstance(seed, np.random.RandomState):
-        rng = seed
-    elif _have_gen and isinstance(seed, np.random.Generator):
-        rng = seed
+    make = _RNG_DISPATCH.get(type(seed))
+    if make is not None:
+        rng = make(seed)
+    elif isinstance(seed, _RNG_TYPES):
+        rng = seed  # subclass of an RNG type
     else:
         rng = _rng_impl.rng(seed)
 
@@ -208,6 +290,10 @@ class FixedRNG:
     def __call__(self, *keys):
         return self.rng
 
+    def batch(self, keys):
+        "Get RNGs for several keys at once, as a dictionary."
+        return dict.fromkeys(keys, self.rng)
+
     def __str__(self):
         return 'Fixed({})'.format(self.rng)
 
@@ -218,14 +304,30 @@ class DerivingRNG:
         self.seed = seed
         self.legacy = legacy
 
-    def __call__(self, *keys):
-        seed = derive_seed(*keys, base=self.seed)
+    def _make_rng(self, seed):
         if self.legacy:
             bg = np.random.MT19937(seed)
             return np.random.RandomState(bg)
         else:
             return np.random.default_rng(seed)
 
+    def __call__(self, *keys):
+        return self._make_rng(derive_seed(*keys, base=self.seed))
+
+    def batch(self, keys):
+        """
+        Get RNGs for several keys at once, as a dictionary.  ``src.batch(keys)[k]``
+        produces the same random numbers as ``src(k)``, but the keys are converted
+        and their seeds derived in bulk.
+        """
+        if not isinstance(keys, np.ndarray):
+            keys = list(keys)
+        # pass arrays through as-is, so the keys are converted in bulk
+        seeds = _rng_impl.derive_each(self.seed, keys)
+        if isinstance(keys, np.ndarray):
+            keys = keys.tolist()
+        return {k: self._make_rng(s) for (k, s) in zip(keys, seeds)}
+
     def __str__(self):
         return 'Derive({})'.format(self.seed)
 
@@ -249,7 +351,8 @@ def derivable_rng(spec, *, legacy=False):
         function:
             A function taking one (or more) key values, like :func:`derive_seed`, and
             returning a random number generator (the type of which is determined by
-            the ``legacy`` parameter).
+            the ``legacy`` parameter).  It also has a ``batch`` method that takes a
+            list of keys and returns a dictionary of RNGs, one for each key.
     """
 
     if spec == 'user':
@@ -263,9 +366,24 @@ def derivable_rng(spec, *, legacy=False):
         return FixedRNG(rng(spec, legacy=legacy))
 
 
+def _use_rng(rng):
+    return rng
+
+
+def _new_rng(seed):
+    return _rng_impl.rng(seed)
+
+
 # are we on modern NumPy?
 _have_gen = hasattr(np.random, 'Generator')
 if _have_gen:
     _rng_impl = ModernRNG()
+    _RNG_TYPES = (np.random.RandomState, np.random.Generator)
 else:
     _rng_impl = LegacyRNG()
+    _RNG_TYPES = (np.random.RandomState,)
+
+# how rng() handles the common seed types, looked up by exact type
+_RNG_DISPATCH = {t: _use_rng for t in _RNG_TYPES}
+_RNG_DISPATCH[type(None)] = _new_rng
+_RNG_DISPATCH[int] = _new_rng
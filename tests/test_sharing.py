@@ -1,4 +1,5 @@
 import pickle
+import uuid
 import numpy as np
 
 import lenskit.util.test as lktu
@@ -43,8 +44,12 @@ def test_store_save(store_cls):
     with store_cls() as store:
         k = store.put_model(algo)
         a2 = store.get_model(k)
-        assert a2 is not algo
-        assert a2.item_pop_ is not algo.item_pop_
+        if store_cls is lks.SHMModelStore:
+            # the storing process gets its own model back
+            assert a2 is algo
+        else:
+            assert a2 is not algo
+            assert a2.item_pop_ is not algo.item_pop_
         assert all(a2.item_pop_ == algo.item_pop_)
         del a2
 
@@ -83,6 +88,117 @@ def test_store_client_pickle(store_cls):
         del a2
 
 
+def test_shm_key_pack():
+    buffers = [('psm_arena', 0, 50), ('psm_arena', 64, 20), ('psm_big', 0, 1 << 40)]
+    key = lks.sharedmem.SHMKey(uuid.uuid4(), ('psm_data', 0, 100), buffers)
+    assert lks.sharedmem.SHMKey.unpack(key.pack()) == key
+
+    k2 = pickle.loads(pickle.dumps(key))
+    assert isinstance(k2, lks.sharedmem.SHMKey)
+    assert k2 == key
+
+
+@mark.skipif(not lks.SHMModelStore.ENABLED, reason='requires shared memory')
+def test_shm_reuse_keys():
+    algo = Popular()
+    algo.fit(lktu.ml_test.ratings)
+
+    with lks.SHMModelStore(reuse_keys=True) as store:
+        k1 = store.put_model(algo)
+        k2 = store.put_model(algo)
+        assert k2 is k1
+        assert len(store.buffers) == 1
+
+        client = store.client()
+        a2 = client.get_model(k2)
+        assert all(a2.item_pop_ == algo.item_pop_)
+        del a2
+
+
+@mark.skipif(not lks.SHMModelStore.ENABLED, reason='requires shared memory')
+def test_shm_arena():
+    model = {'small': [np.full(10 + i, i, dtype=np.float64) for i in range(100)],
+             'big': np.arange(100000, dtype=np.float64)}
+
+    with lks.SHMModelStore() as store:
+        k = store.put_model(model)
+        assert len(store.arena.blocks) == 1
+        assert len(store.buffers[k.id]) == 1
+        assert all(off % 64 == 0 for (bn, off, bs) in k.buffers)
+
+        client = store.client()
+        m2 = client.get_model(k)
+        assert [len(a) for a in m2['small']] == [10 + i for i in range(100)]
+        assert all(np.all(a == i) for i, a in enumerate(m2['small']))
+        assert np.all(m2['big'] == model['big'])
+        assert m2['big'].ctypes.data % 64 == 0
+        del m2
+
+
+@mark.skipif(not lks.SHMModelStore.ENABLED, reason='requires shared memory')
+def test_shm_client_lru():
+    m1 = {'x': np.arange(100000, dtype=np.float64)}
+    m2 = {'x': np.arange(100000, dtype=np.float64) * 2}
+    m3 = {'x': np.arange(100000, dtype=np.float64) * 3}
+
+    with lks.SHMModelStore() as store:
+        keys = [store.put_model(m) for m in [m1, m2, m3]]
+        # room for two models
+        client = lks.sharedmem.SHMClient(cache_size=2000000)
+        client = pickle.loads(pickle.dumps(client))
+        assert client.cache_size == 2000000
+
+        a1 = client.get_model(keys[0])
+        a2 = client.get_model(keys[1])
+        assert client.get_model(keys[0]) is a1
+        assert np.all(a2['x'] == m2['x'])
+
+        # loading the third should evict the second, which is least recently used
+        a3 = client.get_model(keys[2])
+        assert np.all(a3['x'] == m3['x'])
+        assert list(client._cache.keys()) == [keys[0].id, keys[2].id]
+        assert client.get_model(keys[0]) is a1
+        del a1, a2, a3
+        client.clear()
+        assert len(client._cache) == 0
+        assert len(client._retired) == 0
+
+
+@mark.skipif(not lks.SHMModelStore.ENABLED, reason='requires shared memory')
+def test_shm_store_shutdown_clears_cache():
+    # a dict cannot be weakly referenced, so the store loads it from shared memory
+    model = {'x': np.arange(100000, dtype=np.float64)}
+
+    with lks.SHMModelStore() as store:
+        k = store.put_model(model)
+        m2 = store.get_model(k)
+        assert np.all(m2['x'] == model['x'])
+        assert len(store._cache) == 1
+        del m2
+
+    assert len(store._cache) == 0
+    assert len(store._retired) == 0
+
+
+@mark.skipif(not lks.SHMModelStore.ENABLED, reason='requires shared memory')
+def test_shm_client_fallback(monkeypatch):
+    "Test the client without direct POSIX mapping, as on Windows."
+    monkeypatch.setattr(lks.sharedmem, '_posixshmem', None)
+    model = {'small': np.arange(10), 'big': np.arange(100000, dtype=np.float64)}
+
+    with lks.SHMModelStore() as store:
+        k = store.put_model(model)
+        client = store.client()
+
+        m2 = client.get_model(k)
+        assert np.all(m2['small'] == model['small'])
+        assert np.all(m2['big'] == model['big'])
+        blocks, _m, _s = client._cache[k.id]
+        assert all(isinstance(b, lks.sharedmem.shm.SharedMemory) for b in blocks)
+        del m2, _m
+        client.clear()
+
+
 @lktu.wantjit
 @store_param
 def test_store_als(store_cls):
@@ -118,6 +234,27 @@ def test_store_iknn(store_cls):
         del a2
 
 
+@mark.skipif(not lks.SHMModelStore.ENABLED, reason='requires shared memory')
+@mark.parametrize('size', [10, 100000])
+def test_shm_serialized_raw(size, tmp_path):
+    "Test copying pickle files, both small (arena) and large (own block)."
+    model = {'x': np.arange(size, dtype=np.float64)}
+    file = tmp_path / 'model.pkl'
+    with file.open('wb') as f:
+        pickle.dump(model, f)
+
+    with lks.SHMModelStore() as store:
+        k = store.put_serialized_raw(file)
+        assert k.data[2] == file.stat().st_size
+        assert k.buffers == []
+        client = store.client()
+
+        m2 = client.get_model(k)
+        assert np.all(m2['x'] == model['x'])
+        del m2
+        client.clear()
+
+
 def test_create_store():
     with lks.get_store() as store:
         assert len(lks._active_stores()) == 1
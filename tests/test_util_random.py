@@ -1,4 +1,6 @@
 import zlib
+import pickle
+import threading
 import numpy as np
 from lenskit.util import random
 
@@ -123,3 +125,116 @@ def test_derive_seed_str():
     s2 = random.derive_seed(b'wombat')
     assert s2.entropy == 42
     assert s2.spawn_key == (zlib.crc32(b'wombat'),)
+
+
+def test_make_ints():
+    keys = [10, np.int64(7), b'wombat', 'wombat']
+    assert random._make_ints(keys) == [10, 7, zlib.crc32(b'wombat'), zlib.crc32(b'wombat')]
+    assert random._make_ints(np.arange(5)) == [0, 1, 2, 3, 4]
+
+
+@new_gen
+def test_deriving_rng_repeat():
+    src = random.derivable_rng((np.random.SeedSequence(42), 'user'))
+    r1 = src(10).integers(1000000, size=5)
+    r2 = src(10).integers(1000000, size=5)
+    assert np.all(r1 == r2)
+
+    src2 = pickle.loads(pickle.dumps(src))
+    assert np.all(src2(10).integers(1000000, size=5) == r1)
+
+
+@new_gen
+def test_derive_seeds():
+    random.init_rng(42, propagate=False)
+    seeds = random.derive_seeds(3)
+    assert [s.spawn_key for s in seeds] == [(0,), (1,), (2,)]
+    assert random.derive_seed().spawn_key == (3,)
+
+
+@new_gen
+def test_deriving_rng_batch():
+    src = random.derivable_rng((np.random.SeedSequence(42), 'user'))
+    rngs = src.batch(np.arange(5))
+    assert list(rngs.keys()) == list(range(5))
+    for k, r in rngs.items():
+        assert np.all(r.integers(1000000, size=5) == src(k).integers(1000000, size=5))
+
+
+def test_fixed_rng_batch():
+    src = random.derivable_rng(42)
+    rngs = src.batch(['a', 'b'])
+    assert rngs['a'] is src('a')
+    assert rngs['b'] is src('b')
+
+
+@new_gen
+def test_init_rng_thread():
+    random.init_rng(42, propagate=False)
+    seeds = {}
+
+    def worker():
+        seeds['before'] = random.get_root_seed()
+        random.init_rng(100, propagate=False)
+        seeds['after'] = random.get_root_seed()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+
+    # the worker sees the main thread's seed, but its own seed stays in the worker
+    assert seeds['before'].entropy == 42
+    assert seeds['after'].entropy == 100
+    assert random.get_root_seed().entropy == 42
+
+
+@new_gen
+def test_int_seed():
+    random.init_rng(42, propagate=False)
+    ik = random._rng_impl.int_seed
+    assert isinstance(ik, int)
+    assert ik == np.random.SeedSequence(42).generate_state(1)[0]
+    assert random._rng_impl.int_seed == ik
+
+    random.init_rng(43, propagate=False)
+    assert random._rng_impl.int_seed == np.random.SeedSequence(43).generate_state(1)[0]
+
+
+def test_make_ints_strings():
+    strs = ['wombat', 'user 10', '', 'héllo', 'x' * 50]
+    expected = [zlib.crc32(k.encode('utf8')) for k in strs]
+    assert random._make_ints(np.array(strs)) == expected
+    assert random._make_ints(np.array([k.encode('utf8') for k in strs])) == expected
+    assert random._make_ints(strs) == expected
+    assert random._make_ints(np.array([], dtype='U3')) == []
+    assert random._make_ints(np.array([], dtype='S3')) == []
+    assert random._make_ints(np.array([], dtype='i8')) == []
+
+
+@new_gen
+def test_deriving_rng_batch_strings():
+    src = random.derivable_rng((np.random.SeedSequence(42), 'user'))
+    rngs = src.batch(np.array(['a', 'bc']))
+    assert list(rngs.keys()) == ['a', 'bc']
+    assert all(type(k) is str for k in rngs.keys())
+    for k, r in rngs.items():
+        assert np.all(r.integers(1000000, size=5) == src(k).integers(1000000, size=5))
+
+
+@new_gen
+def test_init_rng_no_contextvars(monkeypatch):
+    monkeypatch.setattr(random, '_seed_var', None)
+    random.init_rng(42, propagate=False)
+    assert random.get_root_seed().entropy == 42
+    assert random.derive_seed(10).spawn_key == (10,)
+
+
+@new_gen
+def test_deriving_rng_root_seed():
+    src = random.derivable_rng((None, 'user'))
+    random.init_rng(42, propagate=False)
+    r1 = src(5).integers(1000000, size=5)
+    random.init_rng(43, propagate=False)
+    r2 = src(5).integers(1000000, size=5)
+    assert np.all(r2 == random.rng(random.derive_seed(5)).integers(1000000, size=5))
+    assert not np.all(r1 == r2)